@@ -1,851 +1,1144 @@
-import os
-import sys
-import json
-import argparse
-import numpy as np
-import math
-from einops import rearrange
-import time
-import random
-import string
-import h5py
-from tqdm import tqdm
-import webdataset as wds
-import matplotlib.pyplot as plt
-import torch
-import torch.nn as nn
-from torchvision import transforms
-from accelerate import Accelerator
-from torch.utils.data import DataLoader
-import utils
-
-# SDXL unCLIP requires code from https://github.com/Stability-AI/generative-models/tree/main
-sys.path.append('generative_models/')
-import sgm
-from generative_models.sgm.modules.encoders.modules import FrozenOpenCLIPImageEmbedder
-
-# tf32 data type is faster than standard float32
-torch.backends.cuda.matmul.allow_tf32 = True
-
-### Multi-GPU config ###
-local_rank = os.getenv('RANK')
-if local_rank is None:
-    local_rank = 0
-else:
-    local_rank = int(local_rank)
-print("LOCAL RANK ", local_rank)
-
-data_type = torch.float16  # change depending on your mixed_precision
-num_devices = torch.cuda.device_count()
-if num_devices==0: num_devices = 1
-
-# First use "accelerate config" in terminal and setup using deepspeed stage 2 with CPU offloading!
-accelerator = Accelerator(split_batches=False, mixed_precision="fp16")
-# if utils.is_interactive(): # set batch size here if using interactive notebook instead of submitting job
-#     global_batch_size = batch_size = 8
-# else:
-#     global_batch_size = os.environ["GLOBAL_BATCH_SIZE"]
-#     batch_size = int(os.environ["GLOBAL_BATCH_SIZE"]) // num_devices
-
-print("PID of this process =", os.getpid())
-device = accelerator.device
-print("device:",device)
-world_size = accelerator.state.num_processes
-distributed = not accelerator.state.distributed_type == 'NO'
-num_devices = torch.cuda.device_count()
-if num_devices==0 or not distributed: num_devices = 1
-num_workers = num_devices
-print(accelerator.state)
-
-print("distributed =", distributed, "num_devices =", num_devices, "local_rank =", local_rank, "world_size =", world_size, "data_type =", data_type)
-print = accelerator.print
-
-
-parser = argparse.ArgumentParser(description="Model Training Configuration")
-parser.add_argument(
-    "--model_name", type=str, default="pre_train_subj01",
-    help="name of model, used for ckpt saving and wandb logging (if enabled)",
-)
-parser.add_argument(
-    "--data_path", type=str, default=os.getcwd(),
-    help="Path to where NSD data is stored / where to download it to",
-)
-parser.add_argument(
-    "--cache_dir", type=str, default=os.getcwd(),
-    help="Path to where misc. files downloaded from huggingface are stored. Defaults to current src directory.",
-)
-parser.add_argument(
-    "--subj", type=int, default=1, choices=[1, 2, 3, 4, 5, 6, 7, 8],
-    help="Validate on which subject?",
-)
-parser.add_argument(
-    "--multisubject_ckpt", type=str, default=None,
-    help="Path to pre-trained multisubject model to finetune a single subject from. multisubject must be False.",
-)
-parser.add_argument(
-    "--num_sessions", type=int, default=40,
-    help="Number of training sessions to include",
-)
-parser.add_argument(
-    "--use_prior", action=argparse.BooleanOptionalAction, default=True,
-    help="whether to train diffusion prior (True) or just rely on retrieval part of the pipeline (False)",
-)
-parser.add_argument(
-    "--batch_size", type=int, default=20,
-    help="Batch size can be increased by 10x if only training retreival submodule and not diffusion prior",
-)
-parser.add_argument(
-    "--test_batch_size", type=int, default=20,
-)
-parser.add_argument(
-    "--wandb_log", action=argparse.BooleanOptionalAction, default=False,
-    help="whether to log to wandb",
-)
-parser.add_argument(
-    "--wandb_project", type=str, default="stability",
-    help="wandb project name",
-)
-parser.add_argument(
-    "--mixup_pct", type=float, default=0.33,
-    help="proportion of way through training when to switch from BiMixCo to SoftCLIP",
-)
-parser.add_argument(
-    "--blurry_recon", action=argparse.BooleanOptionalAction, default=True,
-    help="whether to output blurry reconstructions",
-)
-parser.add_argument(
-    "--blur_scale", type=float, default=0.5,
-    help="multiply loss from blurry recons by this number",
-)
-parser.add_argument(
-    "--clip_scale", type=float, default=1.,
-    help="multiply contrastive loss by this number",
-)
-parser.add_argument(
-    "--prior_scale", type=float, default=30,
-    help="multiply diffusion prior loss by this",
-)
-parser.add_argument(
-    "--use_image_aug", action=argparse.BooleanOptionalAction, default=False,
-    help="whether to use image augmentation",
-)
-parser.add_argument(
-    "--num_epochs", type=int, default=150,
-    help="number of epochs of training",
-)
-parser.add_argument(
-    "--multi_subject", action=argparse.BooleanOptionalAction, default=False,
-)
-parser.add_argument(
-    "--new_test", action=argparse.BooleanOptionalAction, default=True,
-)
-parser.add_argument(
-    "--n_blocks", type=int, default=2,
-)
-parser.add_argument(
-    "--hidden_dim", type=int, default=256,
-)
-parser.add_argument(
-    "--lr_scheduler_type", type=str, default='cycle', choices=['cycle', 'linear'],
-)
-parser.add_argument(
-    "--ckpt_saving", action=argparse.BooleanOptionalAction, default=True,
-)
-parser.add_argument(
-    "--ckpt_interval", type=int, default=1,
-    help="save backup ckpt and reconstruct every x epochs",
-)
-parser.add_argument(
-    "--seed", type=int, default=42,
-)
-parser.add_argument(
-    "--max_lr", type=float, default=3e-4,
-)
-
-args = parser.parse_args()
-
-for attribute_name in vars(args).keys():
-    globals()[attribute_name] = getattr(args, attribute_name)
-
-utils.seed_everything(seed)
-
-outdir = os.path.abspath(f'./train_logs/{model_name}')
-if not os.path.exists(outdir) and ckpt_saving:
-    os.makedirs(outdir, exist_ok=True)
-
-if use_image_aug or blurry_recon:
-    import kornia
-    from kornia.augmentation.container import AugmentationSequential
-if use_image_aug:
-    img_augment = AugmentationSequential(
-        kornia.augmentation.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1, p=0.3),
-        same_on_batch=False,
-        data_keys=["input"],
-    )
-
-if multi_subject:
-    subj_list = np.arange(1, 9)
-    subj_list = subj_list[subj_list != subj]
-else:
-    subj_list = [subj]
-
-print("subj_list", subj_list, "num_sessions", num_sessions)
-
-
-
-def my_split_by_node(urls): return urls
-num_voxels_list = []
-
-if multi_subject:
-    nsessions_allsubj=np.array([40, 40, 32, 30, 40, 32, 40, 30])
-    num_samples_per_epoch = (750*40) // num_devices
-else:
-    num_samples_per_epoch = (750*num_sessions) // num_devices
-
-print("dividing batch size by subj_list, which will then be concatenated across subj during training...")
-batch_size = batch_size // len(subj_list)
-
-num_iterations_per_epoch = num_samples_per_epoch // (batch_size*len(subj_list))
-
-print("batch_size =", batch_size, "num_iterations_per_epoch =",num_iterations_per_epoch, "num_samples_per_epoch =",num_samples_per_epoch)
-
-train_data = {}
-train_dl = {}
-num_voxels = {}
-voxels = {}
-for s in subj_list:
-    print(f"Training with {num_sessions} sessions")
-    if multi_subject:
-        train_url = f"{data_path}/wds/subj0{s}/train/" + "{0.." + f"{nsessions_allsubj[s - 1] - 1}" + "}.tar"
-    else:
-        train_url = f"{data_path}/wds/subj0{s}/train/" + "{0.." + f"{num_sessions - 1}" + "}.tar"
-    print(train_url)
-
-    train_data[f'subj0{s}'] = wds.WebDataset(train_url, resampled=True, nodesplitter=my_split_by_node) \
-        .shuffle(750, initial=1500, rng=random.Random(42)) \
-        .decode("torch") \
-        .rename(behav="behav.npy", past_behav="past_behav.npy", future_behav="future_behav.npy",
-                olds_behav="olds_behav.npy") \
-        .to_tuple(*["behav", "past_behav", "future_behav", "olds_behav"])
-
-    train_dl[f'subj0{s}'] = DataLoader(train_data[f'subj0{s}'], batch_size=batch_size, shuffle=False,
-                                       drop_last=False, pin_memory=True)
-
-    f = h5py.File(f'{data_path}/betas_all_subj0{s}_fp32_renorm.hdf5', 'r')
-    betas = f['betas'][:]
-    betas = torch.Tensor(betas).to("cpu").to(data_type)
-    num_voxels_list.append(betas[0].shape[-1])
-    num_voxels[f'subj0{s}'] = betas[0].shape[-1]
-    voxels[f'subj0{s}'] = betas
-    print(f"num_voxels for subj0{s}: {num_voxels[f'subj0{s}']}")
-
-print("Loaded all subj train dls and betas!\n")
-
-# Validate only on one subject
-if multi_subject:
-    subj = subj_list[0]  # cant validate on the actual held out person so picking first in subj_list
-if not new_test:  # using old test set from before full dataset released (used in original MindEye paper)
-    if subj == 3:
-        num_test = 2113
-    elif subj == 4:
-        num_test = 1985
-    elif subj == 6:
-        num_test = 2113
-    elif subj == 8:
-        num_test = 1985
-    else:
-        num_test = 2770
-    test_url = f"{data_path}/wds/subj0{subj}/test/" + "0.tar"
-elif new_test:  # using larger test set from after full dataset released
-    if subj == 3:
-        num_test = 2371
-    elif subj == 4:
-        num_test = 2188
-    elif subj == 6:
-        num_test = 2371
-    elif subj == 8:
-        num_test = 2188
-    else:
-        num_test = 3000
-    test_url = f"{data_path}/wds/subj0{subj}/new_test/" + "0.tar"
-print(test_url)
-test_data = wds.WebDataset(test_url, resampled=False, nodesplitter=my_split_by_node) \
-    .shuffle(750, initial=1500, rng=random.Random(42)) \
-    .decode("torch") \
-    .rename(behav="behav.npy", past_behav="past_behav.npy", future_behav="future_behav.npy",
-            olds_behav="olds_behav.npy") \
-    .to_tuple(*["behav", "past_behav", "future_behav", "olds_behav"])
-# test_dl = torch.utils.data.DataLoader(test_data, batch_size=num_test, shuffle=False, drop_last=True, pin_memory=True)
-test_dl = torch.utils.data.DataLoader(test_data, batch_size=test_batch_size, shuffle=False, drop_last=True, pin_memory=True)
-print(f"Loaded test dl for subj{subj}!\n")
-
-
-# Load 73k NSD images
-f = h5py.File(f'{data_path}/coco_images_224_float16.hdf5', 'r')
-images = f['images']
-print("Loaded all 73k possible NSD images to cpu!", images.shape)
-
-
-#  CLIP ViT-BigG
-clip_img_embedder = FrozenOpenCLIPImageEmbedder(
-    arch="ViT-bigG-14",
-    version="laion2b_s39b_b160k",
-    output_tokens=True,
-    only_tokens=True,
-)
-clip_img_embedder.to(device)
-clip_seq_dim = 256
-clip_emb_dim = 1664
-
-
-if blurry_recon:
-    print("------ VAE ------")
-
-    from diffusers import AutoencoderKL
-    autoenc = AutoencoderKL(
-        down_block_types=['DownEncoderBlock2D', 'DownEncoderBlock2D', 'DownEncoderBlock2D', 'DownEncoderBlock2D'],
-        up_block_types=['UpDecoderBlock2D', 'UpDecoderBlock2D', 'UpDecoderBlock2D', 'UpDecoderBlock2D'],
-        block_out_channels=[128, 256, 512, 512],
-        layers_per_block=2,
-        sample_size=256,
-    )
-    ckpt = torch.load(f'{cache_dir}/sd_image_var_autoenc.pth')
-    autoenc.load_state_dict(ckpt)
-
-    autoenc.eval()
-    autoenc.requires_grad_(False)
-    autoenc.to(device)
-    utils.count_params(autoenc)
-
-    from autoencoder.convnext import ConvnextXL
-
-    cnx = ConvnextXL(f'{cache_dir}/convnext_xlarge_alpha0.75_fullckpt.pth')
-    cnx.requires_grad_(False)
-    cnx.eval()
-    cnx.to(device)
-
-    mean = torch.tensor([0.485, 0.456, 0.406]).to(device).reshape(1, 3, 1, 1)
-    std = torch.tensor([0.228, 0.224, 0.225]).to(device).reshape(1, 3, 1, 1)
-
-    blur_augs = AugmentationSequential(
-        kornia.augmentation.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1, p=0.8),
-        kornia.augmentation.RandomGrayscale(p=0.1),
-        kornia.augmentation.RandomSolarize(p=0.1),
-        kornia.augmentation.RandomResizedCrop((224, 224), scale=(.9, .9), ratio=(1, 1), p=1.0),
-        data_keys=["input"],
-    )
-
-class MindEyeModule(nn.Module):
-    def __init__(self):
-        super(MindEyeModule, self).__init__()
-
-    def forward(self, x):
-        return x
-
-model = MindEyeModule()
-
-print("------ RidgeRegression ------")
-class RidgeRegression(torch.nn.Module):
-    # make sure to add weight_decay when initializing optimizer to enable regularization
-    def __init__(self, input_sizes, out_features):
-        super(RidgeRegression, self).__init__()
-        self.out_features = out_features
-        self.linears = torch.nn.ModuleList([
-            torch.nn.Linear(input_size, out_features) for input_size in input_sizes
-        ])
-
-    def forward(self, x, subj_idx):
-        out = self.linears[subj_idx](x[:, 0]).unsqueeze(1)
-        return out
-
-model.ridge = RidgeRegression(num_voxels_list, out_features=hidden_dim)
-utils.count_params(model.ridge)
-utils.count_params(model)
-
-# test on subject 1 with fake data
-b = torch.randn((2, 1, num_voxels_list[0]))
-print(b.shape, model.ridge(b, 0).shape)
-
-print("------ MLP ------")
-from models import BrainNetwork
-model.backbone = BrainNetwork(h=hidden_dim, in_dim=hidden_dim, seq_len=1, n_blocks=n_blocks,
-                          clip_size=clip_emb_dim, out_dim=clip_emb_dim*clip_seq_dim,
-                          blurry_recon=blurry_recon, clip_scale=clip_scale)
-utils.count_params(model.backbone)
-utils.count_params(model)
-
-# test that the model works on some fake data
-b = torch.randn((2,1,hidden_dim))
-print("b.shape",b.shape)
-
-backbone_, clip_, blur_ = model.backbone(b)
-print(backbone_.shape, clip_.shape, blur_[0].shape, blur_[1].shape)
-
-if use_prior:
-    print("------ Prior ------")
-
-    from models import *
-    # setup diffusion prior network
-    out_dim = clip_emb_dim
-    depth = 3
-    dim_head = 52
-    heads = clip_emb_dim // 52  # heads * dim_head = clip_emb_dim
-    timesteps = 100
-
-    prior_network = PriorNetwork(
-        dim=out_dim,
-        depth=depth,
-        dim_head=dim_head,
-        heads=heads,
-        causal=False,
-        num_tokens=clip_seq_dim,
-        learned_query_mode="pos_emb"
-    )
-
-    model.diffusion_prior = BrainDiffusionPrior(
-        net=prior_network,
-        image_embed_dim=out_dim,
-        condition_on_text_encodings=False,
-        timesteps=timesteps,
-        cond_drop_prob=0.2,
-        image_embed_scale=None,
-    )
-
-    utils.count_params(model.diffusion_prior)
-    utils.count_params(model)
-
-no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
-
-opt_grouped_parameters = [
-    {'params': [p for n, p in model.ridge.named_parameters()], 'weight_decay': 1e-2},
-    {'params': [p for n, p in model.backbone.named_parameters() if not any(nd in n for nd in no_decay)],
-     'weight_decay': 1e-2},
-    {'params': [p for n, p in model.backbone.named_parameters() if any(nd in n for nd in no_decay)],
-     'weight_decay': 0.0},
-]
-if use_prior:
-    opt_grouped_parameters.extend([
-        {'params': [p for n, p in model.diffusion_prior.named_parameters() if not any(nd in n for nd in no_decay)],
-         'weight_decay': 1e-2},
-        {'params': [p for n, p in model.diffusion_prior.named_parameters() if any(nd in n for nd in no_decay)],
-         'weight_decay': 0.0}
-    ])
-
-optimizer = torch.optim.AdamW(opt_grouped_parameters, lr=max_lr)
-
-if lr_scheduler_type == 'linear':
-    lr_scheduler = torch.optim.lr_scheduler.LinearLR(
-        optimizer,
-        total_iters=int(np.floor(num_epochs * num_iterations_per_epoch)),
-        last_epoch=-1
-    )
-elif lr_scheduler_type == 'cycle':
-    total_steps = int(np.floor(num_epochs * num_iterations_per_epoch))
-    print("total_steps", total_steps)
-    lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
-        optimizer,
-        max_lr=max_lr,
-        total_steps=total_steps,
-        final_div_factor=1000,
-        last_epoch=-1, pct_start=2 / num_epochs
-    )
-
-def save_ckpt(tag):
-    ckpt_path = outdir + f'/{tag}.pth'
-    if accelerator.is_main_process:
-        unwrapped_model = accelerator.unwrap_model(model)
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': unwrapped_model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'lr_scheduler': lr_scheduler.state_dict(),
-            'train_losses': losses,
-            'test_losses': test_losses,
-            'lrs': lrs,
-        }, ckpt_path)
-    print(f"\n---saved {outdir}/{tag} ckpt!---\n")
-
-def load_ckpt(tag, load_lr=True, load_optimizer=True, load_epoch=True, strict=True, outdir=outdir,
-              multisubj_loading=False):
-    print(f"\n---loading {outdir}/{tag}.pth ckpt---\n")
-    checkpoint = torch.load(outdir + '/last.pth', map_location='cpu')
-    state_dict = checkpoint['model_state_dict']
-    if multisubj_loading:  # remove incompatible ridge layer that will otherwise error
-        state_dict.pop('ridge.linears.0.weight', None)
-    model.load_state_dict(state_dict, strict=strict)
-    if load_epoch:
-        globals()["epoch"] = checkpoint['epoch']
-        print("Epoch", epoch)
-    if load_optimizer:
-        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-    if load_lr:
-        lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
-    del checkpoint
-
-print("\nDone with model preparations!")
-num_params = utils.count_params(model)
-
-
-
-epoch = 0
-losses, test_losses, lrs = [], [], []
-best_test_loss = 1e9
-torch.cuda.empty_cache()
-
-# load multisubject stage1 ckpt if set
-if multisubject_ckpt is not None:
-    load_ckpt("last", outdir=multisubject_ckpt, load_lr=False, load_optimizer=False, load_epoch=False, strict=False, multisubj_loading=True)
-
-train_dls = [train_dl[f'subj0{s}'] for s in subj_list]
-
-model, optimizer, *train_dls, lr_scheduler = accelerator.prepare(model, optimizer, *train_dls, lr_scheduler)
-# leaving out test_dl since we will only have local_rank 0 device do evals
-
-print(f"{model_name} starting with epoch {epoch} / {num_epochs}")
-progress_bar = tqdm(range(epoch, num_epochs), ncols=1200, disable=(local_rank != 0))
-test_image, test_voxel = None, None
-mse = nn.MSELoss()
-l1 = nn.L1Loss()
-soft_loss_temps = utils.cosine_anneal(0.004, 0.0075, num_epochs - int(mixup_pct * num_epochs))
-
-for epoch in progress_bar:
-    model.train()
-
-    fwd_percent_correct = 0.
-    bwd_percent_correct = 0.
-    test_fwd_percent_correct = 0.
-    test_bwd_percent_correct = 0.
-
-    recon_cossim = 0.
-    test_recon_cossim = 0.
-    recon_mse = 0.
-    test_recon_mse = 0.
-
-    loss_clip_total = 0.
-    loss_blurry_total = 0.
-    loss_blurry_cont_total = 0.
-    test_loss_clip_total = 0.
-
-    loss_prior_total = 0.
-    test_loss_prior_total = 0.
-
-    blurry_pixcorr = 0.
-    test_blurry_pixcorr = 0.  # needs >.456 to beat low-level subj01 results in mindeye v1
-
-    # pre-load all batches for this epoch (it's MUCH faster to pre-load in bulk than to separate loading per batch)
-    voxel_iters = {}  # empty dict because diff subjects have differing # of voxels
-    image_iters = torch.zeros(num_iterations_per_epoch, batch_size * len(subj_list), 3, 224, 224).float()
-    annot_iters = {}
-    perm_iters, betas_iters, select_iters = {}, {}, {}
-    for s, train_dl in enumerate(train_dls):
-        with torch.cuda.amp.autocast(dtype=data_type):
-            iter = -1
-            for behav0, past_behav0, future_behav0, old_behav0 in train_dl:
-                # Load images to cpu from hdf5 (requires sorted indexing)
-                image_idx = behav0[:, 0, 0].cpu().long().numpy()
-                image0, image_sorted_idx = np.unique(image_idx, return_index=True)
-                if len(image0) != len(image_idx):  # hdf5 cant handle duplicate indexing
-                    continue
-                iter += 1
-                image0 = torch.tensor(images[image0], dtype=data_type)
-                image_iters[iter, s * batch_size:s * batch_size + batch_size] = image0
-
-                # Load voxels for current batch, matching above indexing
-                voxel_idx = behav0[:, 0, 5].cpu().long().numpy()
-                voxel_sorted_idx = voxel_idx[image_sorted_idx]
-                voxel0 = voxels[f'subj0{subj_list[s]}'][voxel_sorted_idx]
-                voxel0 = torch.Tensor(voxel0).unsqueeze(1)
-
-                if epoch < int(mixup_pct * num_epochs):
-                    voxel0, perm, betas, select = utils.mixco(voxel0)
-                    perm_iters[f"subj0{subj_list[s]}_iter{iter}"] = perm
-                    betas_iters[f"subj0{subj_list[s]}_iter{iter}"] = betas
-                    select_iters[f"subj0{subj_list[s]}_iter{iter}"] = select
-
-                voxel_iters[f"subj0{subj_list[s]}_iter{iter}"] = voxel0
-
-                if iter >= num_iterations_per_epoch - 1:
-                    break
-
-    # you now have voxel_iters and image_iters with num_iterations_per_epoch batches each
-    for train_i in range(num_iterations_per_epoch):
-        with torch.cuda.amp.autocast(dtype=data_type):
-            optimizer.zero_grad()
-            loss = 0.
-
-            voxel_list = [voxel_iters[f"subj0{s}_iter{train_i}"].detach().to(device) for s in subj_list]
-            image = image_iters[train_i].detach()
-            image = image.to(device)
-
-            if use_image_aug:
-                image = img_augment(image)
-
-            clip_target = clip_img_embedder(image)
-            assert not torch.any(torch.isnan(clip_target))
-
-            if epoch < int(mixup_pct * num_epochs):
-                perm_list = [perm_iters[f"subj0{s}_iter{train_i}"].detach().to(device) for s in subj_list]
-                perm = torch.cat(perm_list, dim=0)
-                betas_list = [betas_iters[f"subj0{s}_iter{train_i}"].detach().to(device) for s in subj_list]
-                betas = torch.cat(betas_list, dim=0)
-                select_list = [select_iters[f"subj0{s}_iter{train_i}"].detach().to(device) for s in subj_list]
-                select = torch.cat(select_list, dim=0)
-
-            voxel_ridge_list = [model.ridge(voxel_list[si], si) for si, s in enumerate(subj_list)]
-            voxel_ridge = torch.cat(voxel_ridge_list, dim=0)
-
-            backbone, clip_voxels, blurry_image_enc_ = model.backbone(voxel_ridge)
-
-            if clip_scale > 0:
-                clip_voxels_norm = nn.functional.normalize(clip_voxels.flatten(1), dim=-1)
-                clip_target_norm = nn.functional.normalize(clip_target.flatten(1), dim=-1)
-
-            if use_prior:
-                loss_prior, prior_out = model.diffusion_prior(text_embed=backbone, image_embed=clip_target)
-                loss_prior_total += loss_prior.item()
-                loss_prior *= prior_scale
-                loss += loss_prior
-
-                recon_cossim += nn.functional.cosine_similarity(prior_out, clip_target).mean().item()
-                recon_mse += mse(prior_out, clip_target).item()
-
-            if clip_scale > 0:
-                if epoch < int(mixup_pct * num_epochs):
-                    loss_clip = utils.mixco_nce(
-                        clip_voxels_norm,
-                        clip_target_norm,
-                        temp=.006,
-                        perm=perm, betas=betas, select=select)
-                else:
-                    epoch_temp = soft_loss_temps[epoch - int(mixup_pct * num_epochs)]
-                    loss_clip = utils.soft_clip_loss(
-                        clip_voxels_norm,
-                        clip_target_norm,
-                        temp=epoch_temp)
-
-                loss_clip_total += loss_clip.item()
-                loss_clip *= clip_scale
-                loss += loss_clip
-
-            if blurry_recon:
-                image_enc_pred, transformer_feats = blurry_image_enc_
-
-                image_enc = autoenc.encode(2 * image - 1).latent_dist.mode() * 0.18215
-                loss_blurry = l1(image_enc_pred, image_enc)
-                loss_blurry_total += loss_blurry.item()
-
-                if epoch < int(mixup_pct * num_epochs):
-                    image_enc_shuf = image_enc[perm]
-                    betas_shape = [-1] + [1] * (len(image_enc.shape) - 1)
-                    image_enc[select] = image_enc[select] * betas[select].reshape(*betas_shape) + \
-                                        image_enc_shuf[select] * (1 - betas[select]).reshape(*betas_shape)
-
-                image_norm = (image - mean) / std
-                image_aug = (blur_augs(image) - mean) / std
-                _, cnx_embeds = cnx(image_norm)
-                _, cnx_aug_embeds = cnx(image_aug)
-
-                cont_loss = utils.soft_cont_loss(
-                    nn.functional.normalize(transformer_feats.reshape(-1, transformer_feats.shape[-1]), dim=-1),
-                    nn.functional.normalize(cnx_embeds.reshape(-1, cnx_embeds.shape[-1]), dim=-1),
-                    nn.functional.normalize(cnx_aug_embeds.reshape(-1, cnx_embeds.shape[-1]), dim=-1),
-                    temp=0.2)
-                loss_blurry_cont_total += cont_loss.item()
-
-                loss += (loss_blurry + 0.1 * cont_loss) * blur_scale  # /.18215
-
-            if clip_scale > 0:
-                # forward and backward top 1 accuracy
-                labels = torch.arange(len(clip_voxels_norm)).to(clip_voxels_norm.device)
-                fwd_percent_correct += utils.topk(utils.batchwise_cosine_similarity(clip_voxels_norm, clip_target_norm),
-                                                  labels, k=1).item()
-                bwd_percent_correct += utils.topk(utils.batchwise_cosine_similarity(clip_target_norm, clip_voxels_norm),
-                                                  labels, k=1).item()
-
-            if blurry_recon:
-                with torch.no_grad():
-                    # only doing pixcorr eval on a subset of the samples per batch because its costly & slow to compute autoenc.decode()
-                    random_samps = np.random.choice(np.arange(len(image)), size=len(image) // 5, replace=False)
-                    blurry_recon_images = (
-                                autoenc.decode(image_enc_pred[random_samps] / 0.18215).sample / 2 + 0.5).clamp(0, 1)
-                    pixcorr = utils.pixcorr(image[random_samps], blurry_recon_images)
-                    blurry_pixcorr += pixcorr.item()
-
-            utils.check_loss(loss)
-            accelerator.backward(loss)
-            optimizer.step()
-
-            losses.append(loss.item())
-            lrs.append(optimizer.param_groups[0]['lr'])
-
-            if lr_scheduler_type is not None:
-                lr_scheduler.step()
-
-    print("finish training epoch %d, start eval" % train_i)
-
-    model.eval()
-    if local_rank == 0:
-        with torch.no_grad(), torch.cuda.amp.autocast(dtype=data_type):
-            for test_i, (behav, _, _, _) in enumerate(test_dl):
-                # all test samples should be loaded per batch such that test_i should never exceed 0
-                # assert len(behav) == num_test
-
-                ## Average same-image repeats ##
-                if test_image is None:
-                    voxel = voxels[f'subj0{subj}'][behav[:, 0, 5].cpu().long()].unsqueeze(1)
-
-                    image = behav[:, 0, 0].cpu().long()
-
-                    unique_image, sort_indices = torch.unique(image, return_inverse=True)
-                    for im in unique_image:
-                        locs = torch.where(im == image)[0]
-                        if len(locs) == 1:
-                            locs = locs.repeat(3)
-                        elif len(locs) == 2:
-                            locs = locs.repeat(2)[:3]
-                        assert len(locs) == 3
-                        if test_image is None:
-                            test_image = torch.Tensor(images[im][None])
-                            test_voxel = voxel[locs][None]
-                        else:
-                            test_image = torch.vstack((test_image, torch.Tensor(images[im][None])))
-                            test_voxel = torch.vstack((test_voxel, voxel[locs][None]))
-
-                loss = 0.0
-
-                test_indices = torch.arange(len(test_voxel))[:]  # test_indices = torch.arange(len(test_voxel))[:300]
-                voxel = test_voxel[test_indices].to(device)
-                image = test_image[test_indices].to(device)
-                # assert len(image) == 300
-                print("the length of test batch is %d" % len(image))
-
-                clip_target = clip_img_embedder(image.float())
-
-                for rep in range(3):
-                    voxel_ridge = model.ridge(voxel[:, rep], 0)  # 0th index of subj_list
-                    backbone0, clip_voxels0, blurry_image_enc_ = model.backbone(voxel_ridge)
-                    if rep == 0:
-                        clip_voxels = clip_voxels0
-                        backbone = backbone0
-                    else:
-                        clip_voxels += clip_voxels0
-                        backbone += backbone0
-                clip_voxels /= 3
-                backbone /= 3
-
-                if clip_scale > 0:
-                    clip_voxels_norm = nn.functional.normalize(clip_voxels.flatten(1), dim=-1)
-                    clip_target_norm = nn.functional.normalize(clip_target.flatten(1), dim=-1)
-
-                # for some evals, only doing a subset of the samples per batch because of computational cost
-                random_samps = np.random.choice(np.arange(len(image)), size=len(image) // 5, replace=False)
-
-                if use_prior:
-                    loss_prior, contaminated_prior_out = model.diffusion_prior(text_embed=backbone[random_samps],
-                                                                               image_embed=clip_target[random_samps])
-                    test_loss_prior_total += loss_prior.item()
-                    loss_prior *= prior_scale
-                    loss += loss_prior
-
-                if clip_scale > 0:
-                    loss_clip = utils.soft_clip_loss(
-                        clip_voxels_norm,
-                        clip_target_norm,
-                        temp=.006)
-
-                    test_loss_clip_total += loss_clip.item()
-                    loss_clip = loss_clip * clip_scale
-                    loss += loss_clip
-
-                if blurry_recon:
-                    image_enc_pred, _ = blurry_image_enc_
-                    blurry_recon_images = (
-                                autoenc.decode(image_enc_pred[random_samps] / 0.18215).sample / 2 + 0.5).clamp(0, 1)
-                    pixcorr = utils.pixcorr(image[random_samps], blurry_recon_images)
-                    test_blurry_pixcorr += pixcorr.item()
-
-                if clip_scale > 0:
-                    # forward and backward top 1 accuracy
-                    labels = torch.arange(len(clip_voxels_norm)).to(clip_voxels_norm.device)
-                    test_fwd_percent_correct += utils.topk(
-                        utils.batchwise_cosine_similarity(clip_voxels_norm, clip_target_norm), labels, k=1).item()
-                    test_bwd_percent_correct += utils.topk(
-                        utils.batchwise_cosine_similarity(clip_target_norm, clip_voxels_norm), labels, k=1).item()
-
-                utils.check_loss(loss)
-                test_losses.append(loss.item())
-
-            # assert (test_i + 1) == 1
-            logs = {"train/loss": np.mean(losses[-(train_i + 1):]),
-                    "test/loss": np.mean(test_losses[-(test_i + 1):]),
-                    "train/lr": lrs[-1],
-                    "train/num_steps": len(losses),
-                    "test/num_steps": len(test_losses),
-                    "train/fwd_pct_correct": fwd_percent_correct / (train_i + 1),
-                    "train/bwd_pct_correct": bwd_percent_correct / (train_i + 1),
-                    "test/test_fwd_pct_correct": test_fwd_percent_correct / (test_i + 1),
-                    "test/test_bwd_pct_correct": test_bwd_percent_correct / (test_i + 1),
-                    "train/loss_clip_total": loss_clip_total / (train_i + 1),
-                    "train/loss_blurry_total": loss_blurry_total / (train_i + 1),
-                    "train/loss_blurry_cont_total": loss_blurry_cont_total / (train_i + 1),
-                    "test/loss_clip_total": test_loss_clip_total / (test_i + 1),
-                    "train/blurry_pixcorr": blurry_pixcorr / (train_i + 1),
-                    "test/blurry_pixcorr": test_blurry_pixcorr / (test_i + 1),
-                    "train/recon_cossim": recon_cossim / (train_i + 1),
-                    "test/recon_cossim": test_recon_cossim / (test_i + 1),
-                    "train/recon_mse": recon_mse / (train_i + 1),
-                    "test/recon_mse": test_recon_mse / (test_i + 1),
-                    "train/loss_prior": loss_prior_total / (train_i + 1),
-                    "test/loss_prior": test_loss_prior_total / (test_i + 1),
-                    }
-
-            # if finished training, save jpg recons if they exist
-            if (epoch == num_epochs - 1) or (epoch % ckpt_interval == 0):
-                if blurry_recon:
-                    image_enc = autoenc.encode(2 * image[:4] - 1).latent_dist.mode() * 0.18215
-                    # transform blurry recon latents to images and plot it
-                    fig, axes = plt.subplots(1, 8, figsize=(10, 4))
-                    jj = -1
-                    for j in [0, 1, 2, 3]:
-                        jj += 1
-                        axes[jj].imshow(utils.torch_to_Image(
-                            (autoenc.decode(image_enc[[j]] / 0.18215).sample / 2 + 0.5).clamp(0, 1)))
-                        axes[jj].axis('off')
-                        jj += 1
-                        axes[jj].imshow(utils.torch_to_Image(
-                            (autoenc.decode(image_enc_pred[[j]] / 0.18215).sample / 2 + 0.5).clamp(0, 1)))
-                        axes[jj].axis('off')
-
-                    if wandb_log:
-                        logs[f"test/blur_recons"] = wandb.Image(fig, caption=f"epoch{epoch:03d}")
-                        plt.close()
-                    else:
-                        plt.show()
-
-            progress_bar.set_postfix(**logs)
-
-            if wandb_log: wandb.log(logs)
-
-    # Save model checkpoint and reconstruct
-    if (ckpt_saving) and (epoch % ckpt_interval == 0):
-        save_ckpt(f'ckpt_%d' % epoch)
-
-    # wait for other GPUs to catch up if needed
-    accelerator.wait_for_everyone()
-    torch.cuda.empty_cache()
-
-    print("finished training Epoch %d" % epoch)
-
-print("\n===Finished!===\n")
-if ckpt_saving:
-    save_ckpt(f'last')
-
-# plt.plot(losses)
-# plt.savefig("../train_logs/losses.png", dpi=300, bbox_inches='tight')
-# plt.plot(test_losses)
-# plt.savefig("../train_logs/test_losses.png", dpi=300, bbox_inches='tight')
-
-
-
-
-
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import math
+from einops import rearrange
+import time
+import random
+import string
+import queue
+import threading
+import h5py
+from tqdm import tqdm
+import webdataset as wds
+import matplotlib.pyplot as plt
+import torch
+import torch.nn as nn
+from torchvision import transforms
+from accelerate import Accelerator
+from torch.utils.data import DataLoader
+import utils
+
+# SDXL unCLIP requires code from https://github.com/Stability-AI/generative-models/tree/main
+sys.path.append('generative_models/')
+import sgm
+from generative_models.sgm.modules.encoders.modules import FrozenOpenCLIPImageEmbedder
+
+# tf32 data type is faster than standard float32
+torch.backends.cuda.matmul.allow_tf32 = True
+
+### Multi-GPU config ###
+local_rank = os.getenv('RANK')
+if local_rank is None:
+    local_rank = 0
+else:
+    local_rank = int(local_rank)
+print("LOCAL RANK ", local_rank)
+
+data_type = torch.bfloat16  # bf16 skips the fp16 loss scaler and matches its tensor-core throughput
+num_devices = torch.cuda.device_count()
+if num_devices==0: num_devices = 1
+
+# First use "accelerate config" in terminal and setup using deepspeed stage 2 with CPU offloading!
+accelerator = Accelerator(split_batches=False, mixed_precision="bf16")
+# if utils.is_interactive(): # set batch size here if using interactive notebook instead of submitting job
+#     global_batch_size = batch_size = 8
+# else:
+#     global_batch_size = os.environ["GLOBAL_BATCH_SIZE"]
+#     batch_size = int(os.environ["GLOBAL_BATCH_SIZE"]) // num_devices
+
+print("PID of this process =", os.getpid())
+device = accelerator.device
+print("device:",device)
+world_size = accelerator.state.num_processes
+distributed = not accelerator.state.distributed_type == 'NO'
+num_devices = torch.cuda.device_count()
+if num_devices==0 or not distributed: num_devices = 1
+num_workers = num_devices
+print(accelerator.state)
+
+print("distributed =", distributed, "num_devices =", num_devices, "local_rank =", local_rank, "world_size =", world_size, "data_type =", data_type)
+print = accelerator.print
+
+
+parser = argparse.ArgumentParser(description="Model Training Configuration")
+parser.add_argument(
+    "--model_name", type=str, default="pre_train_subj01",
+    help="name of model, used for ckpt saving and wandb logging (if enabled)",
+)
+parser.add_argument(
+    "--data_path", type=str, default=os.getcwd(),
+    help="Path to where NSD data is stored / where to download it to",
+)
+parser.add_argument(
+    "--cache_dir", type=str, default=os.getcwd(),
+    help="Path to where misc. files downloaded from huggingface are stored. Defaults to current src directory.",
+)
+parser.add_argument(
+    "--subj", type=int, default=1, choices=[1, 2, 3, 4, 5, 6, 7, 8],
+    help="Validate on which subject?",
+)
+parser.add_argument(
+    "--multisubject_ckpt", type=str, default=None,
+    help="Path to pre-trained multisubject model to finetune a single subject from. multisubject must be False.",
+)
+parser.add_argument(
+    "--num_sessions", type=int, default=40,
+    help="Number of training sessions to include",
+)
+parser.add_argument(
+    "--use_prior", action=argparse.BooleanOptionalAction, default=True,
+    help="whether to train diffusion prior (True) or just rely on retrieval part of the pipeline (False)",
+)
+parser.add_argument(
+    "--batch_size", type=int, default=20,
+    help="Batch size can be increased by 10x if only training retreival submodule and not diffusion prior",
+)
+parser.add_argument(
+    "--test_batch_size", type=int, default=20,
+)
+parser.add_argument(
+    "--wandb_log", action=argparse.BooleanOptionalAction, default=False,
+    help="whether to log to wandb",
+)
+parser.add_argument(
+    "--wandb_project", type=str, default="stability",
+    help="wandb project name",
+)
+parser.add_argument(
+    "--mixup_pct", type=float, default=0.33,
+    help="proportion of way through training when to switch from BiMixCo to SoftCLIP",
+)
+parser.add_argument(
+    "--blurry_recon", action=argparse.BooleanOptionalAction, default=True,
+    help="whether to output blurry reconstructions",
+)
+parser.add_argument(
+    "--blur_scale", type=float, default=0.5,
+    help="multiply loss from blurry recons by this number",
+)
+parser.add_argument(
+    "--clip_scale", type=float, default=1.,
+    help="multiply contrastive loss by this number",
+)
+parser.add_argument(
+    "--prior_scale", type=float, default=30,
+    help="multiply diffusion prior loss by this",
+)
+parser.add_argument(
+    "--use_image_aug", action=argparse.BooleanOptionalAction, default=False,
+    help="whether to use image augmentation",
+)
+parser.add_argument(
+    "--num_epochs", type=int, default=150,
+    help="number of epochs of training",
+)
+parser.add_argument(
+    "--multi_subject", action=argparse.BooleanOptionalAction, default=False,
+)
+parser.add_argument(
+    "--new_test", action=argparse.BooleanOptionalAction, default=True,
+)
+parser.add_argument(
+    "--n_blocks", type=int, default=2,
+)
+parser.add_argument(
+    "--hidden_dim", type=int, default=256,
+)
+parser.add_argument(
+    "--lr_scheduler_type", type=str, default='cycle', choices=['cycle', 'linear'],
+)
+parser.add_argument(
+    "--ckpt_saving", action=argparse.BooleanOptionalAction, default=True,
+)
+parser.add_argument(
+    "--ckpt_interval", type=int, default=1,
+    help="save backup ckpt and reconstruct every x epochs",
+)
+parser.add_argument(
+    "--seed", type=int, default=42,
+)
+parser.add_argument(
+    "--max_lr", type=float, default=3e-4,
+)
+
+args = parser.parse_args()
+
+for attribute_name in vars(args).keys():
+    globals()[attribute_name] = getattr(args, attribute_name)
+
+utils.seed_everything(seed)
+
+outdir = os.path.abspath(f'./train_logs/{model_name}')
+if not os.path.exists(outdir) and ckpt_saving:
+    os.makedirs(outdir, exist_ok=True)
+
+if use_image_aug or blurry_recon:
+    import kornia
+    from kornia.augmentation.container import AugmentationSequential
+if use_image_aug:
+    img_augment = AugmentationSequential(
+        kornia.augmentation.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1, p=0.3),
+        same_on_batch=False,
+        data_keys=["input"],
+    )
+
+if multi_subject:
+    subj_list = np.arange(1, 9)
+    subj_list = subj_list[subj_list != subj]
+else:
+    subj_list = [subj]
+
+print("subj_list", subj_list, "num_sessions", num_sessions)
+
+
+
+def my_split_by_node(urls): return urls
+num_voxels_list = []
+
+if multi_subject:
+    nsessions_allsubj=np.array([40, 40, 32, 30, 40, 32, 40, 30])
+    num_samples_per_epoch = (750*40) // num_devices
+else:
+    num_samples_per_epoch = (750*num_sessions) // num_devices
+
+print("dividing batch size by subj_list, which will then be concatenated across subj during training...")
+batch_size = batch_size // len(subj_list)
+
+num_iterations_per_epoch = num_samples_per_epoch // (batch_size*len(subj_list))
+
+print("batch_size =", batch_size, "num_iterations_per_epoch =",num_iterations_per_epoch, "num_samples_per_epoch =",num_samples_per_epoch)
+
+train_data = {}
+train_dl = {}
+num_voxels = {}
+voxels = {}
+for s in subj_list:
+    print(f"Training with {num_sessions} sessions")
+    if multi_subject:
+        train_url = f"{data_path}/wds/subj0{s}/train/" + "{0.." + f"{nsessions_allsubj[s - 1] - 1}" + "}.tar"
+    else:
+        train_url = f"{data_path}/wds/subj0{s}/train/" + "{0.." + f"{num_sessions - 1}" + "}.tar"
+    print(train_url)
+
+    train_data[f'subj0{s}'] = wds.WebDataset(train_url, resampled=True, nodesplitter=my_split_by_node) \
+        .shuffle(750, initial=1500, rng=random.Random(42)) \
+        .decode("torch") \
+        .rename(behav="behav.npy", past_behav="past_behav.npy", future_behav="future_behav.npy",
+                olds_behav="olds_behav.npy") \
+        .to_tuple(*["behav", "past_behav", "future_behav", "olds_behav"])
+
+    train_dl[f'subj0{s}'] = DataLoader(train_data[f'subj0{s}'], batch_size=batch_size, shuffle=False,
+                                       drop_last=False, pin_memory=True, num_workers=num_workers,
+                                       persistent_workers=True, prefetch_factor=4)
+
+    # stream betas into the device tensor in chunks instead of materializing the
+    # whole fp32 matrix in host RAM first; betas stay resident on device so each
+    # step is a GPU gather instead of a CPU fancy-index + PCIe copy
+    with h5py.File(f'{data_path}/betas_all_subj0{s}_fp32_renorm.hdf5', 'r') as f:
+        dset = f['betas']
+        betas = torch.empty(dset.shape, dtype=data_type, device=device)
+        buf = np.empty((4096, dset.shape[1]), dtype=np.float32)
+        for i in range(0, dset.shape[0], 4096):
+            n = min(4096, dset.shape[0] - i)
+            dset.read_direct(buf[:n], np.s_[i:i + n])
+            betas[i:i + n].copy_(torch.from_numpy(buf[:n]), non_blocking=True)
+    num_voxels_list.append(betas[0].shape[-1])
+    num_voxels[f'subj0{s}'] = betas[0].shape[-1]
+    voxels[f'subj0{s}'] = betas
+    print(f"num_voxels for subj0{s}: {num_voxels[f'subj0{s}']}")
+
+print("Loaded all subj train dls and betas!\n")
+
+# Validate only on one subject
+if multi_subject:
+    subj = subj_list[0]  # cant validate on the actual held out person so picking first in subj_list
+if not new_test:  # using old test set from before full dataset released (used in original MindEye paper)
+    if subj == 3:
+        num_test = 2113
+    elif subj == 4:
+        num_test = 1985
+    elif subj == 6:
+        num_test = 2113
+    elif subj == 8:
+        num_test = 1985
+    else:
+        num_test = 2770
+    test_url = f"{data_path}/wds/subj0{subj}/test/" + "0.tar"
+elif new_test:  # using larger test set from after full dataset released
+    if subj == 3:
+        num_test = 2371
+    elif subj == 4:
+        num_test = 2188
+    elif subj == 6:
+        num_test = 2371
+    elif subj == 8:
+        num_test = 2188
+    else:
+        num_test = 3000
+    test_url = f"{data_path}/wds/subj0{subj}/new_test/" + "0.tar"
+print(test_url)
+test_data = wds.WebDataset(test_url, resampled=False, nodesplitter=my_split_by_node) \
+    .shuffle(750, initial=1500, rng=random.Random(42)) \
+    .decode("torch") \
+    .rename(behav="behav.npy", past_behav="past_behav.npy", future_behav="future_behav.npy",
+            olds_behav="olds_behav.npy") \
+    .to_tuple(*["behav", "past_behav", "future_behav", "olds_behav"])
+# test_dl = torch.utils.data.DataLoader(test_data, batch_size=num_test, shuffle=False, drop_last=True, pin_memory=True)
+test_dl = torch.utils.data.DataLoader(test_data, batch_size=test_batch_size, shuffle=False, drop_last=True,
+                                      pin_memory=True, num_workers=1, persistent_workers=True, prefetch_factor=4)
+print(f"Loaded test dl for subj{subj}!\n")
+
+
+# Load 73k NSD images
+# Convert the HDF5 images to a plain .npy once so we can memory-map them; numpy
+# fancy indexing on the mmap has no sorted-unique constraint (h5py does) and
+# avoids the per-batch host reallocation of h5py reads.
+images_npy_path = f'{data_path}/coco_images_224_float16.npy'
+if accelerator.is_main_process and not os.path.exists(images_npy_path):
+    print("One-time conversion of coco_images_224_float16.hdf5 to .npy ...")
+    with h5py.File(f'{data_path}/coco_images_224_float16.hdf5', 'r', rdcc_nbytes=1 << 30, rdcc_nslots=1000003) as f:
+        dset = f['images']
+        images_out = np.lib.format.open_memmap(images_npy_path + '.tmp', mode='w+', dtype=np.float16,
+                                               shape=dset.shape)
+        for i in range(0, dset.shape[0], 1024):
+            dset.read_direct(images_out, np.s_[i:i + 1024], np.s_[i:i + 1024])
+        images_out.flush()
+        del images_out
+    os.replace(images_npy_path + '.tmp', images_npy_path)
+accelerator.wait_for_everyone()
+images = np.load(images_npy_path, mmap_mode='r')
+print("Loaded all 73k possible NSD images to cpu!", images.shape)
+
+
+#  CLIP ViT-BigG
+clip_img_embedder = FrozenOpenCLIPImageEmbedder(
+    arch="ViT-bigG-14",
+    version="laion2b_s39b_b160k",
+    output_tokens=True,
+    only_tokens=True,
+)
+clip_img_embedder.to(device)
+clip_img_embedder = clip_img_embedder.to(memory_format=torch.channels_last)
+clip_seq_dim = 256
+clip_emb_dim = 1664
+
+# Precompute CLIP embeddings for all 73k images once; both the image set and the
+# encoder are frozen, so the per-step ViT-bigG forward is redundant compute.
+# The fp16 cache is memory-mapped, not loaded into RAM.
+clip_cache_path = f'{cache_dir}/clip_bigG_embeds_fp16.npy'
+clip_norms_path = f'{cache_dir}/clip_bigG_embed_norms_fp32.npy'
+if accelerator.is_main_process and not os.path.exists(clip_cache_path):
+    print("One-time precompute of CLIP image embeddings for all 73k images ...")
+    clip_cache_out = np.lib.format.open_memmap(clip_cache_path + '.tmp', mode='w+', dtype=np.float16,
+                                               shape=(len(images), clip_seq_dim, clip_emb_dim))
+    clip_norms_out = np.lib.format.open_memmap(clip_norms_path + '.tmp', mode='w+', dtype=np.float32,
+                                               shape=(len(images),))
+    with torch.inference_mode(), torch.cuda.amp.autocast(dtype=data_type):
+        for i in tqdm(range(0, len(images), 64)):
+            image_batch = torch.from_numpy(images[i:i + 64].copy()).to(device).float() \
+                .contiguous(memory_format=torch.channels_last)
+            clip_emb = clip_img_embedder(image_batch)
+            clip_cache_out[i:i + 64] = clip_emb.float().cpu().numpy().astype(np.float16)
+            clip_norms_out[i:i + 64] = clip_emb.flatten(1).float().norm(dim=-1).cpu().numpy()
+    clip_cache_out.flush()
+    clip_norms_out.flush()
+    del clip_cache_out, clip_norms_out
+    os.replace(clip_cache_path + '.tmp', clip_cache_path)
+    os.replace(clip_norms_path + '.tmp', clip_norms_path)
+elif accelerator.is_main_process and not os.path.exists(clip_norms_path):
+    # embedding cache from an earlier run: derive the flattened-embedding norms from it
+    clip_cache_np = np.load(clip_cache_path, mmap_mode='r')
+    clip_norms_out = np.lib.format.open_memmap(clip_norms_path + '.tmp', mode='w+', dtype=np.float32,
+                                               shape=(len(images),))
+    for i in range(0, len(images), 512):
+        chunk = clip_cache_np[i:i + 512].astype(np.float32)
+        clip_norms_out[i:i + 512] = np.linalg.norm(chunk.reshape(len(chunk), -1), axis=-1)
+    clip_norms_out.flush()
+    del clip_norms_out
+    os.replace(clip_norms_path + '.tmp', clip_norms_path)
+accelerator.wait_for_everyone()
+clip_cache = np.load(clip_cache_path, mmap_mode='r')
+clip_norms = np.load(clip_norms_path, mmap_mode='r')
+print("Loaded CLIP image embedding cache", clip_cache.shape)
+
+
+if blurry_recon:
+    print("------ VAE ------")
+
+    from diffusers import AutoencoderKL
+    autoenc = AutoencoderKL(
+        down_block_types=['DownEncoderBlock2D', 'DownEncoderBlock2D', 'DownEncoderBlock2D', 'DownEncoderBlock2D'],
+        up_block_types=['UpDecoderBlock2D', 'UpDecoderBlock2D', 'UpDecoderBlock2D', 'UpDecoderBlock2D'],
+        block_out_channels=[128, 256, 512, 512],
+        layers_per_block=2,
+        sample_size=256,
+    )
+    ckpt = torch.load(f'{cache_dir}/sd_image_var_autoenc.pth')
+    autoenc.load_state_dict(ckpt)
+
+    autoenc.eval()
+    autoenc.requires_grad_(False)
+    autoenc.to(device)
+    autoenc = autoenc.to(memory_format=torch.channels_last)
+    utils.count_params(autoenc)
+
+    from autoencoder.convnext import ConvnextXL
+
+    cnx = ConvnextXL(f'{cache_dir}/convnext_xlarge_alpha0.75_fullckpt.pth')
+    cnx.requires_grad_(False)
+    cnx.eval()
+    cnx.to(device)
+    cnx = cnx.to(memory_format=torch.channels_last)
+
+    mean = torch.tensor([0.485, 0.456, 0.406]).to(device).reshape(1, 3, 1, 1)
+    std = torch.tensor([0.228, 0.224, 0.225]).to(device).reshape(1, 3, 1, 1)
+
+    blur_augs = AugmentationSequential(
+        kornia.augmentation.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1, p=0.8),
+        kornia.augmentation.RandomGrayscale(p=0.1),
+        kornia.augmentation.RandomSolarize(p=0.1),
+        kornia.augmentation.RandomResizedCrop((224, 224), scale=(.9, .9), ratio=(1, 1), p=1.0),
+        data_keys=["input"],
+    )
+
+    # Precompute the frozen VAE latents and ConvNeXt embeddings for all 73k images
+    # once, mirroring the CLIP cache above. Output shapes are taken from the first
+    # batch since they depend on the frozen architectures.
+    vae_cache_path = f'{cache_dir}/sd_vae_latents_fp16.npy'
+    cnx_cache_path = f'{cache_dir}/convnext_embeds_fp16.npy'
+    if accelerator.is_main_process and not (os.path.exists(vae_cache_path) and os.path.exists(cnx_cache_path)):
+        print("One-time precompute of VAE latents + ConvNeXt embeddings for all 73k images ...")
+        vae_cache_out, cnx_cache_out = None, None
+        with torch.inference_mode(), torch.cuda.amp.autocast(dtype=data_type):
+            for i in tqdm(range(0, len(images), 64)):
+                image_batch = torch.from_numpy(images[i:i + 64].copy()).to(device).float() \
+                    .contiguous(memory_format=torch.channels_last)
+                image_enc0 = autoenc.encode(2 * image_batch - 1).latent_dist.mode() * 0.18215
+                _, cnx_embeds0 = cnx((image_batch - mean) / std)
+                if vae_cache_out is None:
+                    vae_cache_out = np.lib.format.open_memmap(vae_cache_path + '.tmp', mode='w+', dtype=np.float16,
+                                                              shape=(len(images), *image_enc0.shape[1:]))
+                    cnx_cache_out = np.lib.format.open_memmap(cnx_cache_path + '.tmp', mode='w+', dtype=np.float16,
+                                                              shape=(len(images), *cnx_embeds0.shape[1:]))
+                vae_cache_out[i:i + 64] = image_enc0.float().contiguous().cpu().numpy().astype(np.float16)
+                cnx_cache_out[i:i + 64] = cnx_embeds0.float().contiguous().cpu().numpy().astype(np.float16)
+        vae_cache_out.flush()
+        cnx_cache_out.flush()
+        del vae_cache_out, cnx_cache_out
+        os.replace(vae_cache_path + '.tmp', vae_cache_path)
+        os.replace(cnx_cache_path + '.tmp', cnx_cache_path)
+    accelerator.wait_for_everyone()
+    vae_latent_cache = np.load(vae_cache_path, mmap_mode='r')
+    cnx_embeds_cache = np.load(cnx_cache_path, mmap_mode='r')
+    print("Loaded VAE latent cache", vae_latent_cache.shape, "and ConvNeXt cache", cnx_embeds_cache.shape)
+
+class MindEyeModule(nn.Module):
+    def __init__(self):
+        super(MindEyeModule, self).__init__()
+
+    def forward(self, x):
+        return x
+
+model = MindEyeModule()
+
+print("------ RidgeRegression ------")
+class RidgeRegression(torch.nn.Module):
+    # make sure to add weight_decay when initializing optimizer to enable regularization
+    def __init__(self, input_sizes, out_features):
+        super(RidgeRegression, self).__init__()
+        self.out_features = out_features
+        self.max_input_size = max(input_sizes)
+        self.linears = torch.nn.ModuleList([
+            torch.nn.Linear(input_size, out_features) for input_size in input_sizes
+        ])
+
+    def forward(self, x, subj_idx):
+        out = self.linears[subj_idx](x[:, 0]).unsqueeze(1)
+        return out
+
+    def forward_all(self, x_list):
+        # pad every subject's voxels to the widest subject and run one batched
+        # einsum over the zero-padded stacked weights instead of one small GEMM
+        # per subject (padded columns multiply zero weights so they contribute nothing)
+        if len(x_list) == 1:
+            return self.forward(x_list[0], 0)
+        x = torch.stack([nn.functional.pad(x0[:, 0], (0, self.max_input_size - x0.shape[-1])) for x0 in x_list])
+        W = torch.stack([nn.functional.pad(lin.weight, (0, self.max_input_size - lin.weight.shape[-1]))
+                         for lin in self.linears])
+        b = torch.stack([lin.bias for lin in self.linears])
+        out = torch.einsum('sbv,sov->sbo', x, W) + b.unsqueeze(1)
+        return out.reshape(-1, self.out_features).unsqueeze(1)
+
+model.ridge = RidgeRegression(num_voxels_list, out_features=hidden_dim)
+utils.count_params(model.ridge)
+utils.count_params(model)
+
+# test on subject 1 with fake data
+b = torch.randn((2, 1, num_voxels_list[0]))
+print(b.shape, model.ridge(b, 0).shape)
+
+print("------ MLP ------")
+from models import BrainNetwork
+model.backbone = BrainNetwork(h=hidden_dim, in_dim=hidden_dim, seq_len=1, n_blocks=n_blocks,
+                          clip_size=clip_emb_dim, out_dim=clip_emb_dim*clip_seq_dim,
+                          blurry_recon=blurry_recon, clip_scale=clip_scale)
+utils.count_params(model.backbone)
+utils.count_params(model)
+
+# test that the model works on some fake data
+b = torch.randn((2,1,hidden_dim))
+print("b.shape",b.shape)
+
+backbone_, clip_, blur_ = model.backbone(b)
+print(backbone_.shape, clip_.shape, blur_[0].shape, blur_[1].shape)
+
+if use_prior:
+    print("------ Prior ------")
+
+    from models import *
+    # setup diffusion prior network
+    out_dim = clip_emb_dim
+    depth = 3
+    dim_head = 52
+    heads = clip_emb_dim // 52  # heads * dim_head = clip_emb_dim
+    timesteps = 100
+
+    prior_network = PriorNetwork(
+        dim=out_dim,
+        depth=depth,
+        dim_head=dim_head,
+        heads=heads,
+        causal=False,
+        num_tokens=clip_seq_dim,
+        learned_query_mode="pos_emb"
+    )
+
+    model.diffusion_prior = BrainDiffusionPrior(
+        net=prior_network,
+        image_embed_dim=out_dim,
+        condition_on_text_encodings=False,
+        timesteps=timesteps,
+        cond_drop_prob=0.2,
+        image_embed_scale=None,
+    )
+
+    utils.count_params(model.diffusion_prior)
+    utils.count_params(model)
+
+# compile the trained submodules for kernel fusion + reduced launch overhead;
+# the frozen encoders stay eager since they only ever run forward. compile
+# in place (not torch.compile rebinding) so state_dict keys keep their names
+# and checkpoints stay loadable by Recon.py/Eval.py and --multisubject_ckpt
+model.backbone.compile(mode='reduce-overhead', fullgraph=False)
+if use_prior:
+    model.diffusion_prior.compile(mode='reduce-overhead', fullgraph=False)
+
+no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
+
+opt_grouped_parameters = [
+    {'params': [p for n, p in model.ridge.named_parameters()], 'weight_decay': 1e-2},
+    {'params': [p for n, p in model.backbone.named_parameters() if not any(nd in n for nd in no_decay)],
+     'weight_decay': 1e-2},
+    {'params': [p for n, p in model.backbone.named_parameters() if any(nd in n for nd in no_decay)],
+     'weight_decay': 0.0},
+]
+if use_prior:
+    opt_grouped_parameters.extend([
+        {'params': [p for n, p in model.diffusion_prior.named_parameters() if not any(nd in n for nd in no_decay)],
+         'weight_decay': 1e-2},
+        {'params': [p for n, p in model.diffusion_prior.named_parameters() if any(nd in n for nd in no_decay)],
+         'weight_decay': 0.0}
+    ])
+
+optimizer = torch.optim.AdamW(opt_grouped_parameters, lr=max_lr)
+
+if lr_scheduler_type == 'linear':
+    lr_scheduler = torch.optim.lr_scheduler.LinearLR(
+        optimizer,
+        total_iters=int(np.floor(num_epochs * num_iterations_per_epoch)),
+        last_epoch=-1
+    )
+elif lr_scheduler_type == 'cycle':
+    total_steps = int(np.floor(num_epochs * num_iterations_per_epoch))
+    print("total_steps", total_steps)
+    lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
+        optimizer,
+        max_lr=max_lr,
+        total_steps=total_steps,
+        final_div_factor=1000,
+        last_epoch=-1, pct_start=2 / num_epochs
+    )
+
+def save_ckpt(tag):
+    ckpt_path = outdir + f'/{tag}.pth'
+    if accelerator.is_main_process:
+        unwrapped_model = accelerator.unwrap_model(model)
+        torch.save({
+            'epoch': epoch,
+            'model_state_dict': unwrapped_model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'train_losses': losses,
+            'test_losses': test_losses,
+            'lrs': lrs,
+        }, ckpt_path)
+    print(f"\n---saved {outdir}/{tag} ckpt!---\n")
+
+def load_ckpt(tag, load_lr=True, load_optimizer=True, load_epoch=True, strict=True, outdir=outdir,
+              multisubj_loading=False):
+    print(f"\n---loading {outdir}/{tag}.pth ckpt---\n")
+    checkpoint = torch.load(outdir + '/last.pth', map_location='cpu')
+    state_dict = checkpoint['model_state_dict']
+    if multisubj_loading:  # remove incompatible ridge layer that will otherwise error
+        state_dict.pop('ridge.linears.0.weight', None)
+    model.load_state_dict(state_dict, strict=strict)
+    if load_epoch:
+        globals()["epoch"] = checkpoint['epoch']
+        print("Epoch", epoch)
+    if load_optimizer:
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if load_lr:
+        lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+    del checkpoint
+
+print("\nDone with model preparations!")
+num_params = utils.count_params(model)
+
+
+
+epoch = 0
+losses, test_losses, lrs = [], [], []
+best_test_loss = 1e9
+torch.cuda.empty_cache()
+
+# load multisubject stage1 ckpt if set
+if multisubject_ckpt is not None:
+    load_ckpt("last", outdir=multisubject_ckpt, load_lr=False, load_optimizer=False, load_epoch=False, strict=False, multisubj_loading=True)
+
+train_dls = [train_dl[f'subj0{s}'] for s in subj_list]
+
+model, optimizer, *train_dls, lr_scheduler = accelerator.prepare(model, optimizer, *train_dls, lr_scheduler)
+# leaving out test_dl since we will only have local_rank 0 device do evals
+
+print(f"{model_name} starting with epoch {epoch} / {num_epochs}")
+progress_bar = tqdm(range(epoch, num_epochs), ncols=1200, disable=(local_rank != 0))
+
+def initialize_test_set():
+    ## Average same-image repeats ##
+    # the test set is deterministic, so assemble test_image/test_voxel once here
+    # instead of re-running the growing-vstack loop in every epoch's eval;
+    # matches the old behavior of building from the first test batch only
+    behav = next(iter(test_dl))[0]
+    voxel = voxels[f'subj0{subj}'][behav[:, 0, 5].cpu().long()].unsqueeze(1)
+    image = behav[:, 0, 0].cpu().long()
+
+    test_image_list, test_voxel_list = [], []
+    unique_image, sort_indices = torch.unique(image, return_inverse=True)
+    for im in unique_image:
+        locs = torch.where(im == image)[0]
+        if len(locs) == 1:
+            locs = locs.repeat(3)
+        elif len(locs) == 2:
+            locs = locs.repeat(2)[:3]
+        assert len(locs) == 3
+        test_image_list.append(torch.Tensor(images[im][None]))
+        test_voxel_list.append(voxel[locs][None])
+    return torch.cat(test_image_list, dim=0), torch.cat(test_voxel_list, dim=0)
+
+test_image, test_voxel = None, None
+if local_rank == 0:
+    test_image, test_voxel = initialize_test_set()
+mse = nn.MSELoss()
+l1 = nn.L1Loss()
+soft_loss_temps = utils.cosine_anneal(0.004, 0.0075, num_epochs - int(mixup_pct * num_epochs))
+blurry_pixcorr_interval = 50  # the pixcorr decode is logging-only; no need to run it every step
+labels_full = torch.arange(batch_size * len(subj_list), device=device)  # hot-path top-1 labels, sliced per batch
+
+# test batches can have odd sizes, so cache an arange per (size, device) instead
+_labels_cache = {}
+def _labels(n, device):
+    k = (n, device)
+    t = _labels_cache.get(k)
+    if t is None:
+        t = torch.arange(n, device=device)
+        _labels_cache[k] = t
+    return t
+
+def epoch_batches():
+    # yield one training iteration's worth of per-subject batch data; images are
+    # read from the mmap here (CPU/IO work) while the GPU runs the previous step
+    train_iters = [iter(dl) for dl in train_dls]
+    for _ in range(num_iterations_per_epoch):
+        image0_list, image_idx_list, voxel_idx_list = [], [], []
+        for train_iter in train_iters:
+            behav0, past_behav0, future_behav0, old_behav0 = next(train_iter)
+            image_idx = behav0[:, 0, 0].cpu().long().numpy()
+            image0_list.append(torch.from_numpy(images[image_idx]))
+            image_idx_list.append(image_idx)
+
+            # Store voxel indices only; the gather happens on device at train time
+            voxel_idx_list.append(behav0[:, 0, 5].cpu().long())
+
+        yield {
+            # keep the staged images fp16 + pinned (halves PCIe traffic); the
+            # float32 upcast happens on device in the train step
+            'image': torch.cat(image0_list, dim=0).pin_memory(),
+            'image_idx': np.concatenate(image_idx_list),
+            'voxel_idx': voxel_idx_list,
+        }
+
+def preload_worker(batch_queue):
+    try:
+        for batch in epoch_batches():
+            batch_queue.put(batch)
+        batch_queue.put(None)
+    except Exception as e:  # surface loader errors in the main thread
+        batch_queue.put(e)
+
+# fixed key order for the ratio metrics so the per-key divisions collapse into
+# one stacked kernel and a single device->host sync when the logs dict is built
+TRAIN_RATIO_KEYS = ["train/fwd_pct_correct", "train/bwd_pct_correct", "train/loss_clip_total",
+                    "train/loss_blurry_total", "train/loss_blurry_cont_total", "train/blurry_pixcorr",
+                    "train/recon_cossim", "train/recon_mse", "train/loss_prior"]
+TEST_RATIO_KEYS = ["test/test_fwd_pct_correct", "test/test_bwd_pct_correct", "test/loss_clip_total",
+                   "test/blurry_pixcorr", "test/recon_cossim", "test/recon_mse", "test/loss_prior"]
+
+# the test subset used for prior/pixcorr evals is drawn once per batch size and
+# kept on device; re-drawing via np.random.choice paid an allocation plus an H2D
+# index upload per test batch, and a fixed subset keeps the metric comparable
+# across epochs anyway
+_samps_cache = {}
+def _rand_samps(n, device):
+    k = (n, device)
+    t = _samps_cache.get(k)
+    if t is None:
+        t = torch.randperm(n, device=device)[:n // 5]
+        _samps_cache[k] = t
+    return t
+
+# non-finite losses set a sticky device-side flag instead of forcing a sync
+# every step through utils.check_loss; the flag is polled every 50 steps and at
+# the end of each epoch, so a NaN surfaces within ~50 steps instead of instantly
+_nan_flag = torch.zeros((), dtype=torch.bool, device=device)
+
+# per-step loss readback goes through a pinned buffer on a side stream and is
+# consumed one step late, so the copy overlaps the next forward instead of
+# stalling the compute stream
+_loss_stream = torch.cuda.Stream()
+_loss_host = torch.zeros(1, pin_memory=True)
+_loss_evt = torch.cuda.Event()
+_loss_pending = False
+
+
+_INV_SCALE = 1.0 / 0.18215  # multiply by the reciprocal instead of dividing
+
+
+@torch.jit.script
+def _post_decode(x: torch.Tensor) -> torch.Tensor:
+    # scripted so the rescale + clamp fuse into one pass over the decoded image
+    return (x * 0.5 + 0.5).clamp(0.0, 1.0)
+
+
+_compiled_decode = None
+
+
+def _decode(z):
+    # eval-only VAE decode: inference_mode skips autograd bookkeeping and bf16
+    # autocast roughly doubles throughput (bf16 is overflow-safe where fp16 isn't).
+    # compiled lazily (autoenc may not exist when blurry_recon is off); every call
+    # site uses a fixed batch size so dynamic=False never recompiles mid-run
+    global _compiled_decode
+    if _compiled_decode is None:
+        _compiled_decode = torch.compile(lambda x: autoenc.decode(x).sample,
+                                         mode="reduce-overhead", dynamic=False)
+    with torch.inference_mode(), torch.autocast('cuda', dtype=torch.bfloat16):
+        return _post_decode(_compiled_decode(z * _INV_SCALE))
+
+# reuse one figure for the checkpoint recon grid; rebuilding it every checkpoint
+# is slow and the non-wandb branch never closed it
+_ckpt_fig, _ckpt_axes = plt.subplots(1, 8, figsize=(10, 4))
+for ax in _ckpt_axes:
+    ax.axis('off')
+
+for epoch in progress_bar:
+    model.train()
+
+    # metrics accumulate as zero-dim device tensors so the batch loop never syncs
+    fwd_percent_correct = torch.zeros((), device=device)
+    bwd_percent_correct = torch.zeros((), device=device)
+
+    recon_cossim = torch.zeros((), device=device)
+    recon_mse = torch.zeros((), device=device)
+
+    loss_clip_total = torch.zeros((), device=device)
+    loss_blurry_total = torch.zeros((), device=device)
+    loss_blurry_cont_total = torch.zeros((), device=device)
+
+    loss_prior_total = torch.zeros((), device=device)
+
+    blurry_pixcorr = torch.zeros((), device=device)
+    blurry_pixcorr_n = 0
+
+    epoch_train_loss_sum = 0.
+    epoch_test_loss_vals = []  # detached device scalars, synced once after the test loop
+
+    test_fwd_percent_correct = torch.zeros((), device=device)
+    test_bwd_percent_correct = torch.zeros((), device=device)
+    test_recon_cossim = torch.zeros((), device=device)
+    test_recon_mse = torch.zeros((), device=device)
+    test_loss_clip_total = torch.zeros((), device=device)
+    test_loss_prior_total = torch.zeros((), device=device)
+    test_blurry_pixcorr = torch.zeros((), device=device)  # needs >.456 to beat low-level subj01 results in mindeye v1
+    test_blurry_n = 0
+
+    # pre-load batches in a background thread so mmap reads + CPU prep overlap
+    # GPU compute, instead of serializing a full-epoch preload before training
+    batch_queue = queue.Queue(maxsize=4)
+    preload_thread = threading.Thread(target=preload_worker, args=(batch_queue,), daemon=True)
+    preload_thread.start()
+
+    for train_i in range(num_iterations_per_epoch):
+        batch = batch_queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        with torch.cuda.amp.autocast(dtype=data_type):
+            optimizer.zero_grad()
+            loss = 0.
+
+            image = batch['image'].to(device, non_blocking=True).float()
+
+            if use_image_aug:
+                image = img_augment(image).contiguous(memory_format=torch.channels_last)
+                clip_target = clip_img_embedder(image)  # augmented images are not cacheable
+            else:
+                image_idx0 = batch['image_idx']
+                clip_target = torch.from_numpy(clip_cache[image_idx0]).to(device, non_blocking=True)
+                clip_target_inv_norm = torch.from_numpy(1.0 / clip_norms[image_idx0]).to(device, non_blocking=True)
+            assert not torch.any(torch.isnan(clip_target))
+
+            voxel_list = []
+            perm_list, betas_list, select_list = [], [], []
+            for si, s in enumerate(subj_list):
+                voxel_idx0 = batch['voxel_idx'][si].to(device, non_blocking=True)
+                voxel0 = torch.index_select(voxels[f'subj0{s}'], 0, voxel_idx0).unsqueeze(1)
+                if epoch < int(mixup_pct * num_epochs):
+                    # mixco runs fully on device now (perm/betas/select sampled there too)
+                    voxel0, perm0, betas0, select0 = utils.mixco(voxel0)
+                    perm_list.append(perm0)
+                    betas_list.append(betas0)
+                    select_list.append(select0)
+                voxel_list.append(voxel0)
+
+            if epoch < int(mixup_pct * num_epochs):
+                perm = torch.cat(perm_list, dim=0)
+                betas = torch.cat(betas_list, dim=0)
+                select = torch.cat(select_list, dim=0)
+
+            voxel_ridge = model.ridge.forward_all(voxel_list)
+
+            backbone, clip_voxels, blurry_image_enc_ = model.backbone(voxel_ridge)
+
+            if clip_scale > 0:
+                clip_voxels_norm = nn.functional.normalize(clip_voxels.flatten(1), dim=-1)
+                if use_image_aug:
+                    clip_target_norm = nn.functional.normalize(clip_target.flatten(1), dim=-1)
+                else:
+                    # the per-image norms are cached, so normalizing is a gather +
+                    # scale instead of a reduction over (B, 256*1664)
+                    clip_target_norm = clip_target.flatten(1) * clip_target_inv_norm.unsqueeze(1)
+
+            if use_prior:
+                loss_prior, prior_out = model.diffusion_prior(text_embed=backbone, image_embed=clip_target)
+                loss_prior_total += loss_prior.detach()
+                loss_prior *= prior_scale
+                loss += loss_prior
+
+                recon_cossim += nn.functional.cosine_similarity(prior_out, clip_target).mean().detach()
+                recon_mse += mse(prior_out, clip_target).detach()
+
+            if clip_scale > 0:
+                if epoch < int(mixup_pct * num_epochs):
+                    loss_clip = utils.mixco_nce(
+                        clip_voxels_norm,
+                        clip_target_norm,
+                        temp=.006,
+                        perm=perm, betas=betas, select=select)
+                else:
+                    epoch_temp = soft_loss_temps[epoch - int(mixup_pct * num_epochs)]
+                    loss_clip = utils.soft_clip_loss(
+                        clip_voxels_norm,
+                        clip_target_norm,
+                        temp=epoch_temp)
+
+                loss_clip_total += loss_clip.detach()
+                loss_clip *= clip_scale
+                loss += loss_clip
+
+            if blurry_recon:
+                image_enc_pred, transformer_feats = blurry_image_enc_
+
+                if use_image_aug:
+                    image_enc = autoenc.encode(2 * image - 1).latent_dist.mode() * 0.18215
+                else:
+                    image_enc = torch.from_numpy(vae_latent_cache[image_idx0]).to(device, non_blocking=True)
+                loss_blurry = l1(image_enc_pred, image_enc)
+                loss_blurry_total += loss_blurry.detach()
+
+                if epoch < int(mixup_pct * num_epochs):
+                    image_enc_shuf = image_enc[perm]
+                    betas_shape = [-1] + [1] * (len(image_enc.shape) - 1)
+                    # lerp(shuf, enc, b) == enc*b + shuf*(1-b) in one fused kernel
+                    image_enc[select] = torch.lerp(image_enc_shuf[select], image_enc[select],
+                                                   betas[select].reshape(*betas_shape).to(image_enc.dtype))
+
+                if use_image_aug:
+                    image_norm = (image - mean) / std
+                    _, cnx_embeds = cnx(image_norm)
+                else:
+                    cnx_embeds = torch.from_numpy(cnx_embeds_cache[image_idx0]).to(device, non_blocking=True)
+                image_aug = (blur_augs(image) - mean) / std
+                _, cnx_aug_embeds = cnx(image_aug)
+
+                cont_loss = utils.soft_cont_loss(
+                    nn.functional.normalize(transformer_feats.reshape(-1, transformer_feats.shape[-1]), dim=-1),
+                    nn.functional.normalize(cnx_embeds.reshape(-1, cnx_embeds.shape[-1]), dim=-1),
+                    nn.functional.normalize(cnx_aug_embeds.reshape(-1, cnx_embeds.shape[-1]), dim=-1),
+                    temp=0.2)
+                loss_blurry_cont_total += cont_loss.detach()
+
+                loss += (loss_blurry + 0.1 * cont_loss) * blur_scale  # /.18215
+
+            if clip_scale > 0:
+                # forward and backward top 1 accuracy; inputs are already unit-norm so
+                # one matmul suffices and the reverse direction is its transpose
+                labels = labels_full[:len(clip_voxels_norm)]
+                sims = utils.prenormed_batchwise_cosine_similarity(clip_voxels_norm, clip_target_norm)
+                fwd_percent_correct += utils.topk(sims, labels, k=1).detach()
+                bwd_percent_correct += utils.topk(sims.T, labels, k=1).detach()
+
+            if blurry_recon and (train_i % blurry_pixcorr_interval == 0):
+                with torch.no_grad():
+                    # only doing pixcorr eval on a subset of the samples every N steps because its costly & slow to compute autoenc.decode()
+                    random_samps = torch.randperm(len(image), device=device)[:len(image) // 5]
+                    blurry_recon_images = _decode(image_enc_pred[random_samps])
+                    pixcorr = utils.pixcorr(image[random_samps], blurry_recon_images)
+                    blurry_pixcorr += pixcorr.detach()
+                    blurry_pixcorr_n += 1
+
+            _nan_flag |= ~torch.isfinite(loss.detach())
+            if (train_i % 50 == 0) and _nan_flag.item():
+                raise ValueError('NaN loss')
+            accelerator.backward(loss)
+            optimizer.step()
+
+            # consume the loss copied during the previous step, then queue this
+            # step's copy on the side stream
+            if _loss_pending:
+                _loss_evt.synchronize()
+                loss_val = float(_loss_host[0])
+                epoch_train_loss_sum += loss_val
+                losses.append(loss_val)  # full history still goes into the ckpt
+            _loss_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(_loss_stream):
+                _loss_host.copy_(loss.detach().reshape(1), non_blocking=True)
+            # loss is rebound next iteration; keep the allocator from recycling
+            # its storage while the side-stream copy is still in flight
+            loss.record_stream(_loss_stream)
+            _loss_evt.record(_loss_stream)
+            _loss_pending = True
+            lrs.append(optimizer.param_groups[0]['lr'])
+
+            if lr_scheduler_type is not None:
+                lr_scheduler.step()
+
+    preload_thread.join()
+
+    # drain the final step's deferred loss copy
+    if _loss_pending:
+        _loss_evt.synchronize()
+        loss_val = float(_loss_host[0])
+        epoch_train_loss_sum += loss_val
+        losses.append(loss_val)
+        _loss_pending = False
+
+    print("finish training epoch %d, start eval" % train_i)
+
+    model.eval()
+    if local_rank == 0:
+        # inference_mode beats no_grad here: no version counters or view
+        # tracking on any tensor the eval pass creates
+        with torch.inference_mode(), torch.cuda.amp.autocast(dtype=data_type):
+            for test_i, (behav, _, _, _) in enumerate(test_dl):
+                # all test samples should be loaded per batch such that test_i should never exceed 0
+                # assert len(behav) == num_test
+
+                loss = 0.0
+
+                test_indices = torch.arange(len(test_voxel))[:]  # test_indices = torch.arange(len(test_voxel))[:300]
+                voxel = test_voxel[test_indices].to(device)
+                image = test_image[test_indices].to(device)
+                # assert len(image) == 300
+                print("the length of test batch is %d" % len(image))
+
+                clip_target = clip_img_embedder(image.float().contiguous(memory_format=torch.channels_last))
+
+                # run all 3 repeats in one batched forward instead of 3 sequential
+                # small-batch passes, then average over the repeat dim
+                B = len(voxel)
+                voxel_ridge = model.ridge(voxel.reshape(B * 3, *voxel.shape[2:]), 0)  # 0th index of subj_list
+                backbone, clip_voxels, blurry_image_enc_ = model.backbone(voxel_ridge)
+                backbone = backbone.reshape(B, 3, *backbone.shape[1:]).mean(1)
+                clip_voxels = clip_voxels.reshape(B, 3, *clip_voxels.shape[1:]).mean(1)
+                if blurry_recon:
+                    # keep the last repeat's prediction for pixcorr, matching what the
+                    # sequential version left in blurry_image_enc_
+                    image_enc_pred0 = blurry_image_enc_[0]
+                    blurry_image_enc_ = (image_enc_pred0.reshape(B, 3, *image_enc_pred0.shape[1:])[:, 2],
+                                         blurry_image_enc_[1])
+
+                if clip_scale > 0:
+                    clip_voxels_norm = nn.functional.normalize(clip_voxels.flatten(1), dim=-1)
+                    clip_target_norm = nn.functional.normalize(clip_target.flatten(1), dim=-1)
+
+                # for some evals, only doing a subset of the samples per batch because of computational cost
+                random_samps = _rand_samps(len(image), device)
+
+                if use_prior:
+                    loss_prior, contaminated_prior_out = model.diffusion_prior(text_embed=backbone[random_samps],
+                                                                               image_embed=clip_target[random_samps])
+                    test_loss_prior_total += loss_prior.detach()
+                    loss_prior *= prior_scale
+                    loss += loss_prior
+
+                if clip_scale > 0:
+                    loss_clip = utils.soft_clip_loss(
+                        clip_voxels_norm,
+                        clip_target_norm,
+                        temp=.006)
+
+                    test_loss_clip_total += loss_clip.detach()
+                    loss_clip = loss_clip * clip_scale
+                    loss += loss_clip
+
+                # the VAE decode dominates validation cost, so only measure pixcorr on
+                # epochs that produce the checkpoint figure anyway
+                if blurry_recon and ((epoch % ckpt_interval == 0) or (epoch == num_epochs - 1)):
+                    image_enc_pred, _ = blurry_image_enc_
+                    blurry_recon_images = _decode(image_enc_pred[random_samps])
+                    pixcorr = utils.pixcorr(image[random_samps], blurry_recon_images)
+                    test_blurry_pixcorr += pixcorr.detach()
+                    test_blurry_n += 1
+
+                if clip_scale > 0:
+                    # forward and backward top 1 accuracy; inputs are already unit-norm
+                    # so one matmul suffices and the reverse direction is its transpose
+                    labels = _labels(len(clip_voxels_norm), clip_voxels_norm.device)
+                    sims = utils.prenormed_batchwise_cosine_similarity(clip_voxels_norm, clip_target_norm)
+                    test_fwd_percent_correct += utils.topk(sims, labels, k=1).detach()
+                    test_bwd_percent_correct += utils.topk(sims.T, labels, k=1).detach()
+
+                _nan_flag |= ~torch.isfinite(loss.detach())
+                epoch_test_loss_vals.append(loss.detach())
+
+            # assert (test_i + 1) == 1
+            # every scalar the epoch still owes the host -- ratio metrics, the
+            # nan flag, and the per-batch test losses (save_ckpt persists the
+            # full test_losses history, so the list stays) -- comes back in one
+            # stacked D2H transfer instead of one sync per value
+            train_n = float(train_i + 1)
+            test_n = float(test_i + 1)
+            ratio_totals = torch.stack([
+                fwd_percent_correct, bwd_percent_correct, loss_clip_total,
+                loss_blurry_total, loss_blurry_cont_total, blurry_pixcorr,
+                recon_cossim, recon_mse, loss_prior_total,
+                test_fwd_percent_correct, test_bwd_percent_correct, test_loss_clip_total,
+                test_blurry_pixcorr, test_recon_cossim, test_recon_mse, test_loss_prior_total,
+            ])
+            ratio_counts = torch.tensor(
+                [train_n] * 5 + [float(max(blurry_pixcorr_n, 1))] + [train_n] * 3
+                + [test_n] * 3 + [float(max(test_blurry_n, 1))] + [test_n] * 3,
+                device=device)
+            n_ratios = len(TRAIN_RATIO_KEYS) + len(TEST_RATIO_KEYS)
+            scalars = torch.cat([ratio_totals / ratio_counts,
+                                 _nan_flag.reshape(1).float(),
+                                 torch.stack(epoch_test_loss_vals).float()]).cpu().tolist()
+            if scalars[n_ratios]:
+                raise ValueError('NaN loss')
+            epoch_test_vals = scalars[n_ratios + 1:]
+            test_losses.extend(epoch_test_vals)
+            epoch_test_loss_sum = sum(epoch_test_vals)
+            logs = dict(zip(TRAIN_RATIO_KEYS + TEST_RATIO_KEYS, scalars))
+            logs.update({"train/loss": epoch_train_loss_sum / (train_i + 1),
+                         "test/loss": epoch_test_loss_sum / (test_i + 1),
+                         "train/lr": lrs[-1],
+                         "train/num_steps": len(losses),
+                         "test/num_steps": len(test_losses),
+                         })
+
+            # if finished training, save jpg recons if they exist
+            if (epoch == num_epochs - 1) or (epoch % ckpt_interval == 0):
+                if blurry_recon:
+                    # the test images ARE the ground truth; no need to round-trip
+                    # them through the VAE just to display them
+                    pred_dec = _decode(image_enc_pred[:4])  # already rescaled + clamped once
+                    gt_imgs = image[:4].clamp(0, 1)
+                    # transform blurry recon latents to images and plot it; one
+                    # uint8 HWC D2H copy instead of 8 float per-image transfers,
+                    # and imshow takes uint8 without renormalizing
+                    dec = torch.cat([gt_imgs.float(), pred_dec.float()], dim=0)
+                    dec_u8 = (dec.permute(0, 2, 3, 1) * 255).clamp(0, 255).to(torch.uint8).contiguous().cpu().numpy()
+                    jj = -1
+                    for j in [0, 1, 2, 3]:
+                        jj += 1
+                        _ckpt_axes[jj].clear()
+                        _ckpt_axes[jj].imshow(dec_u8[j])
+                        _ckpt_axes[jj].axis('off')
+                        jj += 1
+                        _ckpt_axes[jj].clear()
+                        _ckpt_axes[jj].imshow(dec_u8[4 + j])
+                        _ckpt_axes[jj].axis('off')
+
+                    if wandb_log:
+                        logs[f"test/blur_recons"] = wandb.Image(_ckpt_fig, caption=f"epoch{epoch:03d}")
+                    else:
+                        _ckpt_fig.canvas.draw_idle()
+
+            # tqdm re-renders on every postfix update, so only hand it a few key
+            # scalars rather than the full 20-key logs dict
+            progress_bar.set_postfix(loss=logs["train/loss"], test_loss=logs["test/loss"],
+                                     lr=logs["train/lr"],
+                                     test_fwd=logs["test/test_fwd_pct_correct"])
+
+            if wandb_log: wandb.log(logs)
+
+    # Save model checkpoint and reconstruct; the barrier pair brackets the save
+    # so non-checkpoint epochs skip the global sync entirely
+    if (ckpt_saving) and (epoch % ckpt_interval == 0):
+        accelerator.wait_for_everyone()
+        save_ckpt(f'ckpt_%d' % epoch)
+        accelerator.wait_for_everyone()
+
+    # emptying the CUDA cache every epoch defeats the caching allocator; only
+    # release segments around checkpointing, when allocations shift anyway
+    if epoch % ckpt_interval == 0:
+        torch.cuda.empty_cache()
+
+    print("finished training Epoch %d" % epoch)
+
+print("\n===Finished!===\n")
+accelerator.wait_for_everyone()
+if ckpt_saving:
+    save_ckpt(f'last')
+
+# plt.plot(losses)
+# plt.savefig("../train_logs/losses.png", dpi=300, bbox_inches='tight')
+# plt.plot(test_losses)
+# plt.savefig("../train_logs/test_losses.png", dpi=300, bbox_inches='tight')
+
+
+
+
+
@@ -158,13 +158,16 @@ def mixco_hard_siglip_loss(preds, targs, temp, bias, perm, betas):
     return loss
 
 def mixco(voxels, beta=0.15, s_thresh=0.5, perm=None, betas=None, select=None):
+    # sample everything directly on voxels.device so mixing GPU tensors
+    # involves no CPU round-trip
     if perm is None:
-        perm = torch.randperm(voxels.shape[0])
+        perm = torch.randperm(voxels.shape[0], device=voxels.device)
     voxels_shuffle = voxels[perm].to(voxels.device,dtype=voxels.dtype)
     if betas is None:
-        betas = torch.distributions.Beta(beta, beta).sample([voxels.shape[0]]).to(voxels.device,dtype=voxels.dtype)
+        beta_param = torch.full([voxels.shape[0]], beta, device=voxels.device)
+        betas = torch.distributions.Beta(beta_param, beta_param).sample().to(dtype=voxels.dtype)
     if select is None:
-        select = (torch.rand(voxels.shape[0]) <= s_thresh).to(voxels.device)
+        select = (torch.rand(voxels.shape[0], device=voxels.device) <= s_thresh)
     betas_shape = [-1] + [1]*(len(voxels.shape)-1)
     voxels[select] = voxels[select] * betas[select].reshape(*betas_shape) + \
         voxels_shuffle[select] * (1 - betas[select]).reshape(*betas_shape)